@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import time
+
+# 起動時間計測の基準（モジュール読み込み開始時点）
+_IMPORT_STARTED_AT = time.monotonic()
+
 import http.server
 import socketserver
 import json
@@ -7,9 +12,12 @@ import subprocess
 import os
 import re
 import uuid
-import argparse
-import pkg_resources
+import itertools
+import threading
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -36,6 +44,45 @@ ENABLE_DEBUG_LOGS = os.getenv('ENABLE_DEBUG_LOGS', 'true').lower() == 'true'
 LOG_FILE_PATH = os.getenv('LOG_FILE_PATH', 'logs/claude_chat.log')
 CORS_ALLOW_ORIGIN = os.getenv('CORS_ALLOW_ORIGIN', '*')
 ENABLE_CORS = os.getenv('ENABLE_CORS', 'true').lower() == 'true'
+STREAM_REPLAY_BUFFER_SIZE = int(os.getenv('STREAM_REPLAY_BUFFER_SIZE', 500))
+STREAM_KEEPALIVE_INTERVAL = int(os.getenv('STREAM_KEEPALIVE_INTERVAL', 15))
+STREAM_RUN_RETENTION_SECONDS = int(os.getenv('STREAM_RUN_RETENTION_SECONDS', 600))
+MAX_STREAM_RUNS_RETAINED = int(os.getenv('MAX_STREAM_RUNS_RETAINED', 100))
+JOB_TIMEOUT = int(os.getenv('JOB_TIMEOUT', 1800))
+JOB_MAX_TIMEOUT = int(os.getenv('JOB_MAX_TIMEOUT', 7200))
+MAX_JOBS_PER_SESSION = int(os.getenv('MAX_JOBS_PER_SESSION', 2))
+MAX_JOBS_RETAINED = int(os.getenv('MAX_JOBS_RETAINED', 100))
+BATCH_MAX_DIRECTORIES = int(os.getenv('BATCH_MAX_DIRECTORIES', 20))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 4))
+ENABLE_CHANGE_TRACKING = os.getenv('ENABLE_CHANGE_TRACKING', 'true').lower() == 'true'
+CHANGE_TRACKER_MAX_FILES = int(os.getenv('CHANGE_TRACKER_MAX_FILES', 20000))
+CHANGE_TRACKER_MAX_FILE_SIZE = int(os.getenv('CHANGE_TRACKER_MAX_FILE_SIZE', 256 * 1024))
+CHANGE_TRACKER_MAX_CACHED_BYTES = int(os.getenv('CHANGE_TRACKER_MAX_CACHED_BYTES', 32 * 1024 * 1024))
+CHANGE_TRACKER_MAX_TRACKERS = int(os.getenv('CHANGE_TRACKER_MAX_TRACKERS', 8))
+CHANGE_HISTORY_MAX_SESSIONS = int(os.getenv('CHANGE_HISTORY_MAX_SESSIONS', 20))
+CHANGE_TRACKER_IGNORE_DIRS = set(os.getenv(
+    'CHANGE_TRACKER_IGNORE_DIRS',
+    '.git,node_modules,__pycache__,.venv,venv,.mypy_cache,.pytest_cache,.ruff_cache,.tox'
+).split(','))
+JOBS_DIRECTORY = os.path.join(STARTUP_DIRECTORY, os.getenv('JOBS_DIRECTORY', 'logs/jobs'))
+RATE_LIMIT_SESSION_PER_MINUTE = float(os.getenv('RATE_LIMIT_SESSION_PER_MINUTE', 6))
+RATE_LIMIT_SESSION_BURST = int(os.getenv('RATE_LIMIT_SESSION_BURST', 3))
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('RATE_LIMIT_IP_PER_MINUTE', 20))
+RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', 10))
+QUOTA_WINDOW_SECONDS = int(os.getenv('QUOTA_WINDOW_SECONDS', 3600))
+SESSION_COST_QUOTA_USD = float(os.getenv('SESSION_COST_QUOTA_USD', 5.0))
+SESSION_CPU_QUOTA_SECONDS = float(os.getenv('SESSION_CPU_QUOTA_SECONDS', 1800))
+STARTUP_TIME_BUDGET_MS = int(os.getenv('STARTUP_TIME_BUDGET_MS', 500))
+ENABLE_COMPRESSION = os.getenv('ENABLE_COMPRESSION', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))
+
+# Content-Encoding ごとの zlib wbits（deflate は HTTP の定義どおり zlib 形式）
+COMPRESSION_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# 起動完了までの所要時間と起動完了時刻（main() で設定）
+STARTUP_TIME_MS = None
+SERVER_STARTED_AT = None
 
 # 会話セッションを保持（インスタンスごと）
 chat_sessions = {}
@@ -43,8 +90,640 @@ chat_sessions = {}
 # セッションごとの作業ディレクトリを保持（インスタンスごと）
 session_directories = {}
 
+# セッションごとの最新ストリーミングラン（再接続用、古い順）
+stream_runs = OrderedDict()
+stream_runs_lock = threading.Lock()
+
+# SSEイベントIDの採番（全ランを通して単調増加）
+_event_id_counter = itertools.count(1)
+
+
+def register_stream_run(session_id, run):
+    """セッションの最新ランとして登録し、保持期間を過ぎたか上限を超えた終了済みランを破棄
+
+    セッションIDはクライアントが決めるため、終了済みランを残し続けない（stream_runs_lock 保持中に呼ぶ）。
+    """
+    stream_runs[session_id] = run
+    stream_runs.move_to_end(session_id)
+    
+    now = time.monotonic()
+    finished = [(key, old_run) for key, old_run in stream_runs.items() if old_run.finished]
+    excess = len(finished) - MAX_STREAM_RUNS_RETAINED
+    for index, (key, old_run) in enumerate(finished):
+        if index < excess or now - old_run.finished_at > STREAM_RUN_RETENTION_SECONDS:
+            del stream_runs[key]
+
+class TokenBucket:
+    """トークンバケット方式のレート制限（1リクエストあたりO(1)）"""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def is_full(self, now):
+        """時刻 now の時点で満タンまで回復しているか（削除しても挙動が変わらない）"""
+        return self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+    def try_consume(self):
+        """トークンを1つ消費する。不足時は再試行までの秒数を返す（成功時は0）"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RollingUsage:
+    """時間バケットで集計するローリングウィンドウの使用量（コスト・実行時間）
+
+    バケット幅はウィンドウの1/60（1〜60秒）なので、短いウィンドウでも精度が保たれる。
+    """
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = max(1, min(60, window_seconds // 60))
+        self.buckets = deque()  # [バケット開始時刻(秒), コスト, 実行時間ms]
+        self.total_cost = 0.0
+        self.total_ms = 0
+
+    def _expire(self, now):
+        while self.buckets and self.buckets[0][0] + self.window_seconds <= now:
+            _, cost, duration_ms = self.buckets.popleft()
+            self.total_cost -= cost
+            self.total_ms -= duration_ms
+
+    def add(self, cost, duration_ms):
+        now = time.time()
+        self._expire(now)
+        bucket_start = int(now // self.bucket_seconds) * self.bucket_seconds
+        if self.buckets and self.buckets[-1][0] == bucket_start:
+            self.buckets[-1][1] += cost
+            self.buckets[-1][2] += duration_ms
+        else:
+            self.buckets.append([bucket_start, cost, duration_ms])
+        self.total_cost += cost
+        self.total_ms += duration_ms
+
+    def totals(self):
+        self._expire(time.time())
+        return self.total_cost, self.total_ms
+
+    def is_empty(self):
+        self._expire(time.time())
+        return not self.buckets
+
+    def retry_after(self):
+        """最も古いバケットがウィンドウから外れるまでの秒数"""
+        if not self.buckets:
+            return 0
+        return max(1, (self.buckets[0][0] + self.window_seconds) - time.time())
+
+
+# セッション・クライアントIPごとのレート制限とクォータ
+session_rate_buckets = {}
+ip_rate_buckets = {}
+session_usage = {}
+rate_limit_lock = threading.Lock()
+
+# アイドルなエントリを掃除する間隔（セッションIDはクライアントが決めるため無制限に増えうる）
+RATE_LIMIT_PRUNE_INTERVAL = 60
+_rate_limit_pruned_at = time.monotonic()
+
+
+def prune_rate_limits():
+    """満タンのバケットと空の使用量を削除（rate_limit_lock 保持中に呼ぶ）"""
+    global _rate_limit_pruned_at
+    now = time.monotonic()
+    if now - _rate_limit_pruned_at < RATE_LIMIT_PRUNE_INTERVAL:
+        return
+    _rate_limit_pruned_at = now
+    
+    for buckets in (session_rate_buckets, ip_rate_buckets):
+        for key in [key for key, bucket in buckets.items() if bucket.is_full(now)]:
+            del buckets[key]
+    for session_id in [session_id for session_id, usage in session_usage.items() if usage.is_empty()]:
+        del session_usage[session_id]
+
+
+def _check_session_quota(session_id):
+    """コスト・実行時間のクォータを確認（rate_limit_lock 保持中に呼ぶ）"""
+    usage = session_usage.get(session_id)
+    if usage is not None:
+        total_cost, total_ms = usage.totals()
+        if SESSION_COST_QUOTA_USD > 0 and total_cost >= SESSION_COST_QUOTA_USD:
+            return f"コスト上限に達しました (${total_cost:.4f} / ${SESSION_COST_QUOTA_USD:.2f})", usage.retry_after()
+        if SESSION_CPU_QUOTA_SECONDS > 0 and total_ms >= SESSION_CPU_QUOTA_SECONDS * 1000:
+            return f"実行時間の上限に達しました ({total_ms / 1000:.0f}秒 / {SESSION_CPU_QUOTA_SECONDS:.0f}秒)", usage.retry_after()
+    return None
+
+
+def check_session_quota(session_id):
+    """クォータのみを確認し、超過時は (エラーメッセージ, 再試行秒数) を返す（バッチの各ディレクトリ用）"""
+    with rate_limit_lock:
+        return _check_session_quota(session_id)
+
+
+def check_request_limits(session_id, client_ip):
+    """レート制限とクォータを確認し、超過時は (エラーメッセージ, 再試行秒数) を返す"""
+    with rate_limit_lock:
+        prune_rate_limits()
+        
+        quota = _check_session_quota(session_id)
+        if quota is not None:
+            return quota
+        
+        if RATE_LIMIT_IP_PER_MINUTE > 0:
+            bucket = ip_rate_buckets.get(client_ip)
+            if bucket is None:
+                bucket = ip_rate_buckets[client_ip] = TokenBucket(RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_IP_BURST)
+            retry_after = bucket.try_consume()
+            if retry_after:
+                return "リクエストが多すぎます（クライアント単位）", retry_after
+        
+        if RATE_LIMIT_SESSION_PER_MINUTE > 0:
+            bucket = session_rate_buckets.get(session_id)
+            if bucket is None:
+                bucket = session_rate_buckets[session_id] = TokenBucket(RATE_LIMIT_SESSION_PER_MINUTE, RATE_LIMIT_SESSION_BURST)
+            retry_after = bucket.try_consume()
+            if retry_after:
+                return "リクエストが多すぎます（セッション単位）", retry_after
+    
+    return None
+
+
+def record_session_usage(session_id, cost, duration_ms):
+    """resultイベントのコストと実行時間をセッションのクォータに計上"""
+    with rate_limit_lock:
+        usage = session_usage.get(session_id)
+        if usage is None:
+            usage = session_usage[session_id] = RollingUsage(QUOTA_WINDOW_SECONDS)
+        usage.add(cost or 0.0, duration_ms or 0)
+
+
+# ツールごとのレイテンシヒストグラム（バケット上限はミリ秒）
+TOOL_LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+tool_latency_histograms = {}
+tool_latency_lock = threading.Lock()
+
+
+def record_tool_latency(tool_name, duration_ms):
+    """ツールの実行時間をヒストグラムに記録"""
+    with tool_latency_lock:
+        histogram = tool_latency_histograms.get(tool_name)
+        if histogram is None:
+            histogram = {
+                "count": 0,
+                "sum_ms": 0,
+                "max_ms": 0,
+                "buckets": [0] * (len(TOOL_LATENCY_BUCKETS_MS) + 1)  # 最後は上限超過
+            }
+            tool_latency_histograms[tool_name] = histogram
+        
+        histogram["count"] += 1
+        histogram["sum_ms"] += duration_ms
+        histogram["max_ms"] = max(histogram["max_ms"], duration_ms)
+        for index, upper_bound in enumerate(TOOL_LATENCY_BUCKETS_MS):
+            if duration_ms <= upper_bound:
+                histogram["buckets"][index] += 1
+                break
+        else:
+            histogram["buckets"][-1] += 1
+
+
+class StreamRun:
+    """HTTP接続から切り離されたストリーミングランとリプレイバッファ"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.events = deque(maxlen=STREAM_REPLAY_BUFFER_SIZE)
+        self.finished = False
+        self.finished_at = None
+        self.condition = threading.Condition()
+        self.process = None
+        self.return_code = None
+        self.timed_out = False
+        self.cancelled = False
+        self.final_response = None
+        self.cost = 0.0
+        self.started_at = time.time()
+        self.tool_timeline = []
+        self.pending_tools = {}
+
+    def publish(self, data):
+        """イベントにIDを付与してバッファに追加し、待機中のクライアントへ通知"""
+        with self.condition:
+            event_id = next(_event_id_counter)
+            self.events.append((event_id, data))
+            self.condition.notify_all()
+        return event_id
+
+    def finish(self):
+        """ランの終了を通知"""
+        with self.condition:
+            self.finished = True
+            self.finished_at = time.monotonic()
+            self.condition.notify_all()
+
+    def outcome(self):
+        """CLI実行の結果ステータスを返す"""
+        if self.cancelled:
+            return 'cancelled'
+        if self.timed_out:
+            return 'timeout'
+        if self.return_code == 0:
+            return 'completed'
+        return 'failed'
+
+    def cancel(self):
+        """実行中のCLIプロセスを停止"""
+        self.cancelled = True
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+
+    def add_tool_entry(self, entry):
+        """ツール呼び出しをタイムラインに記録"""
+        self.tool_timeline.append(entry)
+
+    def wait_for_events(self, last_event_id, timeout):
+        """last_event_id より新しいイベントを待って返す（タイムアウト時は空リスト）"""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.finished or (self.events and self.events[-1][0] > last_event_id),
+                timeout
+            )
+            pending = [(event_id, data) for event_id, data in self.events if event_id > last_event_id]
+            return pending, self.finished
+
+    def timeline_summary(self):
+        """ツール呼び出しのタイムラインを集計して返す"""
+        completed = [entry for entry in self.tool_timeline if entry["duration_ms"] is not None]
+        return {
+            "session_id": self.session_id,
+            "finished": self.finished,
+            "tool_count": len(self.tool_timeline),
+            "total_tool_ms": sum(entry["duration_ms"] for entry in completed),
+            "total_output_size": sum(entry["output_size"] for entry in completed),
+            "timeline": self.tool_timeline
+        }
+
+
+class BatchRun(StreamRun):
+    """バッチ実行全体のラン（キャンセルは実行中の各ディレクトリへ伝播）"""
+
+    def __init__(self, session_id):
+        super().__init__(session_id)
+        self.targets = []
+        self.targets_lock = threading.Lock()
+
+    def add_target(self, target_run):
+        with self.targets_lock:
+            self.targets.append(target_run)
+            # 登録前にキャンセルされていた場合も子ランに反映
+            if self.cancelled:
+                target_run.cancel()
+
+    def cancel(self):
+        """全ディレクトリのCLIプロセスを停止（未開始のディレクトリは run_batch_target で飛ばす）"""
+        with self.targets_lock:
+            self.cancelled = True
+            for target_run in self.targets:
+                if not target_run.finished:
+                    target_run.cancel()
+
+
+class BatchTargetRun(StreamRun):
+    """バッチ実行の1ディレクトリ分（イベントはディレクトリを付けて親ランへ転送）"""
+
+    def __init__(self, parent, directory):
+        super().__init__(parent.session_id)
+        self.parent = parent
+        self.directory = directory
+        parent.add_target(self)
+
+    def publish(self, data):
+        if isinstance(data, dict):
+            data = dict(data, directory=self.directory)
+        return self.parent.publish(data)
+
+    def add_tool_entry(self, entry):
+        # 親ランのタイムラインにも同じエントリを登録（終了時の更新が両方に反映される）
+        entry["directory"] = self.directory
+        super().add_tool_entry(entry)
+        self.parent.add_tool_entry(entry)
+
+
+class ChangeTracker:
+    """作業ディレクトリの mtime/size スナップショット索引（差分用に小さなテキストファイルの内容も保持）"""
+
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {}      # ディレクトリ -> (mtime_ns, ファイル名リスト, サブディレクトリ名リスト)
+        self.files = {}     # ファイル -> (mtime_ns, size)
+        self.contents = {}  # ファイル -> 直近スナップショット時点の内容
+        self.cached_bytes = 0
+        self.truncated = False
+        self.indexed = False   # 索引を一度でも作成したか
+        self.warmed = False    # 既存ファイルの内容を読み込み済みか
+        self.active = False    # 変更を追跡中のランがあるか（change_trackers_lock で保護）
+        self.overlapped = False
+        self.evicted = False
+        self.lock = threading.Lock()
+
+    def refresh(self, cache_contents=True):
+        """索引を更新し、変化したファイルの {パス: 変更前の内容} を返す
+
+        mtime が変わったディレクトリだけを再走査し、それ以外はキャッシュした
+        一覧を使う（その場で書き換えられたファイルを検出するため stat は行う）。
+        cache_contents が False の場合は stat のみで、内容は warm() で後から読む。
+        """
+        replaced = {}
+        seen_dirs = set()
+        seen_files = set()
+        stack = [self.root]
+        self.truncated = False
+        
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            seen_dirs.add(path)
+            
+            cached = self.dirs.get(path)
+            if cached is not None and cached[0] == mtime:
+                _, file_names, subdir_names = cached
+            else:
+                file_names, subdir_names = [], []
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name not in CHANGE_TRACKER_IGNORE_DIRS and entry.path != JOBS_DIRECTORY:
+                                    subdir_names.append(entry.name)
+                            elif entry.is_file(follow_symlinks=False):
+                                file_names.append(entry.name)
+                except OSError:
+                    pass
+                self.dirs[path] = (mtime, file_names, subdir_names)
+            
+            for name in file_names:
+                file_path = os.path.join(path, name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                seen_files.add(file_path)
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if self.files.get(file_path) != signature:
+                    replaced[file_path] = self._pop_content(file_path)
+                    self.files[file_path] = signature
+                    if cache_contents:
+                        self._cache_content(file_path, stat.st_size)
+            
+            if len(seen_files) > CHANGE_TRACKER_MAX_FILES:
+                self.truncated = True
+                break
+            stack.extend(os.path.join(path, name) for name in subdir_names)
+        
+        # 打ち切った場合は未走査の項目を削除扱いにしない
+        if not self.truncated:
+            for removed_dir in set(self.dirs) - seen_dirs:
+                del self.dirs[removed_dir]
+            for removed_file in set(self.files) - seen_files:
+                replaced[removed_file] = self._pop_content(removed_file)
+                del self.files[removed_file]
+        
+        self.indexed = True
+        return replaced
+
+    def warm(self):
+        """リクエスト処理の外で索引を作成し、未読み込みのファイル内容をキャッシュする"""
+        with self.lock:
+            # 追跡中のランがあれば索引を更新しない（そのランの変更前の状態が失われる）
+            if self.evicted or self.active or self.warmed:
+                return
+            started_at = time.monotonic()
+            self.refresh(cache_contents=False)
+            for file_path, (_, size) in list(self.files.items()):
+                if file_path not in self.contents:
+                    self._cache_content(file_path, size)
+            self.warmed = True
+        print(f"[DEBUG] 変更トラッカー準備完了: {self.root} ({len(self.files)} files, "
+              f"{self.cached_bytes // 1024}KB, {round((time.monotonic() - started_at) * 1000)}ms)")
+
+    @staticmethod
+    def read_text(file_path):
+        """差分表示用にファイルを読み込む（バイナリや大きすぎる場合は None）"""
+        try:
+            if os.path.getsize(file_path) > CHANGE_TRACKER_MAX_FILE_SIZE:
+                return None
+            with open(file_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if b'\0' in data:
+            return None
+        return data.decode('utf-8', errors='replace')
+
+    def _cache_content(self, file_path, size):
+        # 上限は全トラッカー合計のバイト数
+        if self.evicted or size > CHANGE_TRACKER_MAX_FILE_SIZE or not reserve_tracker_bytes(size):
+            return
+        content = self.read_text(file_path)
+        if content is None:
+            release_tracker_bytes(size)
+            return
+        self.contents[file_path] = content
+        self.cached_bytes += size
+
+    def _pop_content(self, file_path):
+        content = self.contents.pop(file_path, None)
+        if content is not None:
+            size = self.files.get(file_path, (0, 0))[1]
+            self.cached_bytes -= size
+            release_tracker_bytes(size)
+        return content
+
+
+# 作業ディレクトリごとの変更トラッカー（最近使った順）と、全トラッカー合計のキャッシュ量
+change_trackers = OrderedDict()
+change_trackers_lock = threading.Lock()
+change_tracker_cached_bytes = 0
+
+# セッションごとの直近の変更内容（古いセッションから破棄）
+session_changes = OrderedDict()  # セッションID -> {ディレクトリ: 変更内容}
+session_changes_lock = threading.Lock()
+
+
+def reserve_tracker_bytes(size):
+    """全体の上限内であればキャッシュ量を確保して True を返す"""
+    global change_tracker_cached_bytes
+    with change_trackers_lock:
+        if change_tracker_cached_bytes + size > CHANGE_TRACKER_MAX_CACHED_BYTES:
+            return False
+        change_tracker_cached_bytes += size
+        return True
+
+
+def release_tracker_bytes(size):
+    global change_tracker_cached_bytes
+    with change_trackers_lock:
+        change_tracker_cached_bytes -= size
+
+
+def _evict_change_trackers(keep):
+    """使われていないトラッカーを古い順に破棄（change_trackers_lock 保持中に呼ぶ）
+
+    トラッカー数が上限を超えているか、キャッシュが全体の上限に達している間、
+    keep 以外で追跡中でもロック中でもないものを破棄する。
+    """
+    global change_tracker_cached_bytes
+    for directory, tracker in list(change_trackers.items()):
+        over_count = len(change_trackers) > CHANGE_TRACKER_MAX_TRACKERS
+        over_bytes = change_tracker_cached_bytes >= CHANGE_TRACKER_MAX_CACHED_BYTES
+        if not over_count and not over_bytes:
+            break
+        if not over_count and tracker.cached_bytes == 0:
+            continue
+        if tracker is keep or tracker.active or not tracker.lock.acquire(blocking=False):
+            continue
+        try:
+            tracker.evicted = True
+            change_tracker_cached_bytes -= tracker.cached_bytes
+            tracker.contents.clear()
+            tracker.cached_bytes = 0
+            del change_trackers[directory]
+        finally:
+            tracker.lock.release()
+
+
+def _get_change_tracker(directory):
+    """トラッカーを取得（なければ作成）し、最近使ったものとして記録（change_trackers_lock 保持中に呼ぶ）"""
+    tracker = change_trackers.get(directory)
+    if tracker is None:
+        tracker = change_trackers[directory] = ChangeTracker(directory)
+    change_trackers.move_to_end(directory)
+    _evict_change_trackers(tracker)
+    return tracker
+
+
+def get_change_tracker(directory):
+    """ディレクトリの変更トラッカーを取得（なければ作成）"""
+    with change_trackers_lock:
+        return _get_change_tracker(directory)
+
+
+def acquire_change_tracker(directory):
+    """ラン用にトラッカーを確保（同じディレクトリで追跡中のランがあれば None）"""
+    with change_trackers_lock:
+        tracker = _get_change_tracker(directory)
+        if tracker.active:
+            # 先行ランの変更一覧には、このランの変更も混ざりうることを記録
+            tracker.overlapped = True
+            return None
+        tracker.active = True
+        tracker.overlapped = False
+        return tracker
+
+
+def release_change_tracker(tracker):
+    """ランの終了時にトラッカーを解放し、未読み込みの内容があればバックグラウンドで読む"""
+    with change_trackers_lock:
+        tracker.active = False
+    if not tracker.warmed:
+        warm_change_tracker(tracker.root)
+
+
+def warm_change_tracker(directory):
+    """トラッカーの準備をバックグラウンドで開始（ディレクトリ選択時など）"""
+    if ENABLE_CHANGE_TRACKING and os.path.isdir(directory):
+        threading.Thread(target=lambda: get_change_tracker(directory).warm(), daemon=True).start()
+
+
+def store_session_changes(session_id, directory, changes):
+    """セッションの変更内容を保存し、件数か変更前の内容の合計が上限を超えたら古いセッションから破棄"""
+    with session_changes_lock:
+        session_changes.setdefault(session_id, {})[directory] = changes
+        session_changes.move_to_end(session_id)
+        
+        def before_bytes(directory_changes):
+            return sum(changes["before_bytes"] for changes in directory_changes.values())
+        
+        total_bytes = sum(before_bytes(entry) for entry in session_changes.values())
+        while len(session_changes) > 1 and (len(session_changes) > CHANGE_HISTORY_MAX_SESSIONS
+                                            or total_bytes > CHANGE_TRACKER_MAX_CACHED_BYTES):
+            _, evicted = session_changes.popitem(last=False)
+            total_bytes -= before_bytes(evicted)
+
+
+# バックグラウンドジョブ（ジョブIDごと、インスタンスごと）
+jobs = {}
+jobs_lock = threading.Lock()
+
+
+class Job(StreamRun):
+    """HTTP接続やストリームタイムアウトから切り離して実行するバックグラウンドジョブ"""
+
+    def __init__(self, session_id, message, timeout):
+        super().__init__(session_id)
+        self.job_id = uuid.uuid4().hex[:12]
+        self.message = message
+        self.timeout = timeout
+        self.status = 'running'
+        self.created_at = datetime.now().isoformat()
+        self.finished_at = None
+        self.event_log_path = os.path.join(JOBS_DIRECTORY, f"{self.job_id}.events.jsonl")
+        self.result_path = os.path.join(JOBS_DIRECTORY, f"{self.job_id}.json")
+
+    def publish(self, data):
+        """イベントを発行し、イベントログにも追記"""
+        event_id = super().publish(data)
+        try:
+            with open(self.event_log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"id": event_id, "data": data}, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"[ERROR] ジョブイベントログ書き込みエラー ({self.job_id}): {e}")
+        return event_id
+
+    def finish(self):
+        """最終ステータスを確定して結果を保存"""
+        self.status = self.outcome()
+        self.finished_at = datetime.now().isoformat()
+        self.save()
+        super().finish()
+        print(f"[INFO] ジョブ終了: {self.job_id} ({self.status})")
+
+    def save(self):
+        """ジョブの状態と結果をファイルに保存"""
+        try:
+            with open(self.result_path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            print(f"[ERROR] ジョブ結果保存エラー ({self.job_id}): {e}")
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "message": self.message,
+            "status": self.status,
+            "timeout": self.timeout,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "result": self.final_response
+        }
+
+
 class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
     
+    # SSEの圧縮ストリーム（send_stream_headers で設定）
+    stream_compressor = None
+    
     def do_GET(self):
         # favicon.icoのリクエストを処理
         if self.path == '/favicon.ico':
@@ -52,6 +731,48 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             self.end_headers()
             return
         
+        request_path = urlparse(self.path).path
+        
+        # ヘルスチェック（プロセスを起動せずに応答）
+        if request_path == '/healthz':
+            self.handle_healthz()
+            return
+        if request_path == '/readyz':
+            self.handle_readyz()
+            return
+        
+        # ストリームへの再接続
+        if request_path == '/api/chat/stream':
+            self.handle_stream_resume()
+            return
+        
+        # 実行中に変更されたファイル
+        if request_path == '/api/changes':
+            self.handle_changes()
+            return
+        
+        # ツール実行タイムライン・メトリクス
+        if request_path == '/api/chat/timeline':
+            self.handle_chat_timeline()
+            return
+        if request_path == '/api/metrics/tools':
+            self.handle_tool_metrics()
+            return
+        
+        # バックグラウンドジョブAPI
+        if request_path == '/api/jobs':
+            self.handle_job_list()
+            return
+        job_match = re.match(r'^/api/jobs/([0-9a-f]+)(/stream|/timeline)?$', request_path)
+        if job_match:
+            if job_match.group(2) == '/stream':
+                self.handle_job_stream(job_match.group(1))
+            elif job_match.group(2) == '/timeline':
+                self.handle_job_timeline(job_match.group(1))
+            else:
+                self.handle_job_status(job_match.group(1))
+            return
+        
         # HTMLファイルのリクエストを処理
         if self.path == '/claude_chat.html' or self.path == '/':
             try:
@@ -62,11 +783,7 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                 with open(html_path, 'r', encoding='utf-8') as f:
                     content = f.read()
                 
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/html; charset=utf-8')
-                self.send_header('Cache-Control', 'no-cache')
-                self.end_headers()
-                self.wfile.write(content.encode('utf-8'))
+                self.send_body(content.encode('utf-8'), 'text/html; charset=utf-8', headers={'Cache-Control': 'no-cache'})
                 return
             except FileNotFoundError:
                 self.send_error(404, "HTML file not found")
@@ -81,10 +798,18 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
         elif self.path == '/api/chat/stream':
             # ストリーミングAPIを実装
             self.handle_chat_stream()
+        elif self.path == '/api/chat/batch':
+            self.handle_chat_batch()
+        elif self.path == '/api/chat/cancel':
+            self.handle_chat_cancel()
         elif self.path == '/api/directory/change':
             self.handle_directory_change()
         elif self.path == '/api/directory/info':
             self.handle_directory_info()
+        elif self.path == '/api/jobs':
+            self.handle_job_submit()
+        elif re.match(r'^/api/jobs/[0-9a-f]+/cancel$', self.path):
+            self.handle_job_cancel(self.path.split('/')[3])
         else:
             self.send_error(404, "Not Found")
     
@@ -100,6 +825,9 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             
             print(f"\n[{datetime.now().strftime('%H:%M:%S')}] User ({session_id[:8]}): {user_message}")
             
+            if not self.enforce_request_limits(session_id):
+                return
+            
             # セッション履歴を取得または初期化
             if session_id not in chat_sessions:
                 chat_sessions[session_id] = []
@@ -117,8 +845,10 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             # コンテキストを構築（設定値に基づく）
             context = "\n".join(history[-CONTEXT_WINDOW_SIZE:])
             
-            # Claude Code CLIに送信
+            # Claude Code CLIに送信（通常モードはコスト情報がないため実行時間のみ計上）
+            started_at = time.monotonic()
             response = self.handle_claude_conversation(user_message, context, session_id)
+            record_session_usage(session_id, 0.0, int((time.monotonic() - started_at) * 1000))
             
             print(f"[{datetime.now().strftime('%H:%M:%S')}] Assistant: {response[:100]}...")
             
@@ -135,12 +865,7 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                 "timestamp": datetime.now().isoformat()
             }
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            self.wfile.write(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+            self.send_json_response(result, headers={'Cache-Control': 'no-cache'})
             
         except Exception as e:
             import traceback
@@ -148,11 +873,7 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             print(f"[ERROR] {error_msg}")
             print(traceback.format_exc())
             
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": error_msg}, ensure_ascii=False).encode('utf-8'))
+            self.send_json_response({"error": error_msg}, 500)
     
     def handle_chat_stream(self):
         """ストリーミング対応のチャットハンドラ"""
@@ -167,6 +888,19 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             
             print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Stream User ({session_id[:8]}): {user_message}")
             
+            if not self.enforce_request_limits(session_id):
+                return
+            
+            # 同一セッションでの多重実行を防止
+            with stream_runs_lock:
+                active_run = stream_runs.get(session_id)
+                if active_run and not active_run.finished:
+                    error_msg = "このセッションでは既に処理が実行中です"
+                    self.send_json_response({"error": error_msg, "session_id": session_id}, 409)
+                    return
+                run = StreamRun(session_id)
+                register_stream_run(session_id, run)
+            
             # セッション履歴を取得または初期化
             if session_id not in chat_sessions:
                 chat_sessions[session_id] = []
@@ -181,32 +915,16 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             # ユーザーメッセージを履歴に追加（ディレクトリ情報も含める）
             history.append(f"User: {user_message} [作業ディレクトリ: {current_dir}]")
             
-            # ストリーミングレスポンスのヘッダー設定
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-            self.send_header('Connection', 'close')  # 接続を確実に閉じる
-            self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
-            self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-            self.end_headers()
-            
-            # 即座にフラッシュ
-            self.wfile.flush()
-            
-            # ストリーミング実行
-            final_response = self.handle_claude_stream(user_message, session_id)
-            
-            # 応答を履歴に追加（ディレクトリ情報も含める）
-            history.append(f"Assistant: {final_response} [作業ディレクトリ: {current_dir}]")
-            
-            # セッションを保存（設定値に基づく）
-            chat_sessions[session_id] = history[-MAX_MESSAGES_PER_SESSION:]
+            # CLI実行はHTTP接続から切り離してバックグラウンドで行う
+            worker = threading.Thread(
+                target=self.run_stream_worker,
+                args=(run, user_message, session_id, current_dir),
+                daemon=True
+            )
+            worker.start()
             
-            # 終了シグナル
-            self.wfile.write(b'data: [DONE]\n\n')
-            self.wfile.flush()
+            self.send_stream_headers()
+            self.relay_stream_events(run, 0)
             
             print(f"[DEBUG] ストリーミング完了: {session_id[:8]}")
             
@@ -219,15 +937,612 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             print(traceback.format_exc())
             
             try:
-                error_data = json.dumps({"error": error_msg}, ensure_ascii=False)
-                self.wfile.write(f'data: {error_data}\n\n'.encode('utf-8'))
-                self.wfile.write(b'data: [DONE]\n\n')
-                self.wfile.flush()
+                self.send_stream_data({"error": error_msg})
+                self.send_stream_data('[DONE]')
+                self.end_stream()
             except:
                 pass
     
-    def handle_claude_stream(self, message, session_id):
-        """Claude Code CLIをストリーミング実行"""
+    def handle_chat_batch(self):
+        """1つのプロンプトを複数ディレクトリで並列実行し、SSEで多重化して配信"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+            
+            user_message = data.get('message', '')
+            session_id = data.get('session_id', str(uuid.uuid4()))
+            directories = data.get('directories', [])
+            
+            if not user_message or not isinstance(directories, list) or not directories:
+                self.send_json_response({"error": "message と directories を指定してください"}, 400)
+                return
+            
+            try:
+                concurrency = data.get('concurrency')
+                concurrency = BATCH_MAX_CONCURRENCY if concurrency is None else int(concurrency)
+            except (TypeError, ValueError):
+                concurrency = 0
+            if concurrency <= 0:
+                self.send_json_response({"error": "concurrency には正の整数を指定してください"}, 400)
+                return
+            concurrency = min(concurrency, BATCH_MAX_CONCURRENCY)
+            if len(directories) > BATCH_MAX_DIRECTORIES:
+                self.send_json_response({"error": f"ディレクトリは {BATCH_MAX_DIRECTORIES} 件までです"}, 400)
+                return
+            
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Batch User ({session_id[:8]}): {user_message} ({len(directories)} dirs)")
+            
+            if not self.enforce_request_limits(session_id):
+                return
+            
+            # 同一セッションでの多重実行を防止
+            with stream_runs_lock:
+                active_run = stream_runs.get(session_id)
+                if active_run and not active_run.finished:
+                    error_msg = "このセッションでは既に処理が実行中です"
+                    self.send_json_response({"error": error_msg, "session_id": session_id}, 409)
+                    return
+                run = BatchRun(session_id)
+                register_stream_run(session_id, run)
+            
+            # セッション履歴を取得または初期化
+            if session_id not in chat_sessions:
+                chat_sessions[session_id] = []
+                session_directories[session_id] = STARTUP_DIRECTORY  # 起動時ディレクトリを設定
+                print(f"[INFO] 新しいセッション作成: {session_id[:8]} (作業ディレクトリ: {session_directories[session_id]})")
+            
+            # 相対パスはセッションの作業ディレクトリを基準に解決（重複は除外）
+            current_dir = session_directories.get(session_id, STARTUP_DIRECTORY)
+            targets = []
+            for directory in directories:
+                target_path = os.path.abspath(os.path.join(current_dir, str(directory)))
+                if target_path not in targets:
+                    targets.append(target_path)
+            
+            chat_sessions[session_id].append(f"User: {user_message} [バッチ実行: {', '.join(targets)}]")
+            
+            worker = threading.Thread(
+                target=self.run_batch_worker,
+                args=(run, user_message, session_id, targets, concurrency),
+                daemon=True
+            )
+            worker.start()
+            
+            self.send_stream_headers()
+            self.relay_stream_events(run, 0)
+            
+            print(f"[DEBUG] バッチ実行完了: {session_id[:8]}")
+            
+        except BrokenPipeError:
+            print(f"[INFO] クライアント接続切断: {session_id[:8] if 'session_id' in locals() else 'unknown'}")
+        except Exception as e:
+            import traceback
+            error_msg = f"バッチ実行エラー: {str(e)}"
+            print(f"[ERROR] {error_msg}")
+            print(traceback.format_exc())
+            self.send_json_response({"error": error_msg}, 500)
+    
+    def run_batch_worker(self, run, user_message, session_id, targets, concurrency):
+        """各ディレクトリのCLI実行を並列数の上限つきで実行し、集計結果を発行"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        started_at = time.monotonic()
+        try:
+            run.publish({
+                "type": "batch_init",
+                "message": f"{len(targets)} ディレクトリで実行を開始します（並列数 {concurrency}）",
+                "session_id": session_id,
+                "directories": targets
+            })
+            
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(
+                    lambda target: self.run_batch_target(run, user_message, session_id, target),
+                    targets
+                ))
+            
+            summary = {
+                "type": "batch_summary",
+                "session_id": session_id,
+                "results": results,
+                "succeeded": sum(1 for result in results if result["status"] == 'completed'),
+                "failed": sum(1 for result in results if result["status"] not in ('completed', 'skipped', 'cancelled')),
+                "skipped": sum(1 for result in results if result["status"] == 'skipped'),
+                "cancelled": sum(1 for result in results if result["status"] == 'cancelled'),
+                "total_cost": round(sum(result["cost"] for result in results), 6),
+                "duration_ms": round((time.monotonic() - started_at) * 1000)
+            }
+            run.final_response = summary
+            run.publish(summary)
+            
+            # 集計結果を履歴に追加
+            lines = [f"- {result['directory']}: {result['status']} ({result['duration_ms'] / 1000:.1f}秒, ${result['cost']:.4f})"
+                     for result in results]
+            history = chat_sessions.get(session_id, [])
+            history.append("Assistant: バッチ実行結果:\n" + "\n".join(lines))
+            chat_sessions[session_id] = history[-MAX_MESSAGES_PER_SESSION:]
+        except Exception as e:
+            import traceback
+            error_msg = f"バッチ実行エラー: {str(e)}"
+            print(f"[ERROR] {error_msg}")
+            print(traceback.format_exc())
+            run.publish({"error": error_msg})
+        finally:
+            # 終了シグナル
+            run.publish('[DONE]')
+            run.finish()
+    
+    def run_batch_target(self, run, user_message, session_id, directory):
+        """バッチ実行の1ディレクトリ分を実行して結果を返す"""
+        target_run = BatchTargetRun(run, directory)
+        started_at = time.monotonic()
+        
+        # 先に終わったディレクトリのコストも含めて、開始直前にクォータを再確認
+        quota = check_session_quota(session_id)
+        if run.cancelled:
+            status = 'cancelled'
+            response = "⚠️ 処理がキャンセルされました"
+        elif not os.path.isdir(directory):
+            status = 'error'
+            response = f"ディレクトリが存在しません: {directory}"
+        elif quota is not None:
+            status = 'skipped'
+            response = f"⚠️ {quota[0]}"
+        else:
+            target_run.publish({"type": "batch_start", "session_id": session_id})
+            response = self.handle_claude_stream(user_message, session_id, target_run, working_dir=directory)
+            status = target_run.outcome()
+        
+        result = {
+            "directory": directory,
+            "status": status,
+            "duration_ms": round((time.monotonic() - started_at) * 1000),
+            "cost": target_run.cost,
+            "response": response
+        }
+        target_run.publish(dict(result, type="batch_result", session_id=session_id))
+        target_run.finish()
+        print(f"[INFO] バッチ実行 {directory}: {status}")
+        return result
+    
+    def handle_stream_resume(self):
+        """切断されたストリームへの再接続（Last-Event-ID 以降のイベントを再送）"""
+        query = parse_qs(urlparse(self.path).query)
+        session_id = query.get('session_id', [''])[0]
+        last_event_id = self.headers.get('Last-Event-ID') or query.get('last_event_id', ['0'])[0]
+        
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            last_event_id = 0
+        
+        run = stream_runs.get(session_id)
+        if run is None:
+            error_msg = "再接続可能なストリームがありません"
+            self.send_json_response({"error": error_msg, "session_id": session_id}, 404)
+            return
+        
+        print(f"[INFO] ストリーム再接続: {session_id[:8]} (Last-Event-ID: {last_event_id})")
+        
+        try:
+            self.send_stream_headers()
+            self.relay_stream_events(run, last_event_id)
+        except BrokenPipeError:
+            print(f"[INFO] クライアント接続切断: {session_id[:8]}")
+    
+    def handle_chat_cancel(self):
+        """実行中のストリーミングランのキャンセルAPI（ESCキャンセル用）"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+            session_id = data.get('session_id', '')
+        except Exception as e:
+            self.send_json_response({"error": f"リクエストが不正です: {str(e)}"}, 400)
+            return
+        
+        run = stream_runs.get(session_id)
+        if run is None:
+            self.send_json_response({"error": "キャンセル可能なストリームがありません", "session_id": session_id}, 404)
+            return
+        
+        if not run.finished:
+            run.cancel()
+            print(f"[INFO] ストリームキャンセル: {session_id[:8]}")
+        
+        self.send_json_response({"session_id": session_id, "cancelled": run.cancelled, "finished": run.finished})
+    
+    def handle_job_submit(self):
+        """バックグラウンドジョブ投入API"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode('utf-8'))
+            
+            user_message = data.get('message', '')
+            session_id = data.get('session_id', str(uuid.uuid4()))
+            
+            if not user_message:
+                self.send_json_response({"error": "メッセージが指定されていません"}, 400)
+                return
+            
+            # タイムアウトは正の秒数のみ受け付け、上限で切り詰める
+            try:
+                timeout = data.get('timeout')
+                timeout = JOB_TIMEOUT if timeout is None else int(timeout)
+            except (TypeError, ValueError):
+                timeout = 0
+            if timeout <= 0:
+                self.send_json_response({"error": "timeout には正の整数（秒）を指定してください"}, 400)
+                return
+            timeout = min(timeout, JOB_MAX_TIMEOUT)
+            
+            if not self.enforce_request_limits(session_id):
+                return
+            
+            # セッションごとの同時実行数を制限
+            with jobs_lock:
+                running = [job for job in jobs.values() if job.session_id == session_id and not job.finished]
+                if len(running) >= MAX_JOBS_PER_SESSION:
+                    error_msg = f"同時に実行できるジョブは {MAX_JOBS_PER_SESSION} 件までです"
+                    self.send_json_response({"error": error_msg, "session_id": session_id}, 429)
+                    return
+                job = Job(session_id, user_message, timeout)
+                jobs[job.job_id] = job
+                
+                # 古い終了済みジョブをメモリから除去（結果はファイルに残る）
+                finished_ids = [job_id for job_id, j in jobs.items() if j.finished]
+                for job_id in finished_ids[:max(0, len(jobs) - MAX_JOBS_RETAINED)]:
+                    del jobs[job_id]
+            
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Job {job.job_id} ({session_id[:8]}): {user_message}")
+            
+            # セッション履歴を取得または初期化
+            if session_id not in chat_sessions:
+                chat_sessions[session_id] = []
+                session_directories[session_id] = STARTUP_DIRECTORY  # 起動時ディレクトリを設定
+                print(f"[INFO] 新しいセッション作成: {session_id[:8]} (作業ディレクトリ: {session_directories[session_id]})")
+            
+            current_dir = session_directories.get(session_id, STARTUP_DIRECTORY)
+            chat_sessions[session_id].append(f"User: {user_message} [作業ディレクトリ: {current_dir}]")
+            
+            os.makedirs(JOBS_DIRECTORY, exist_ok=True)
+            job.save()
+            
+            worker = threading.Thread(
+                target=self.run_stream_worker,
+                args=(job, user_message, session_id, current_dir, job.timeout),
+                daemon=True
+            )
+            worker.start()
+            
+            self.send_json_response(job.to_dict(), 202)
+            
+        except Exception as e:
+            error_msg = f"ジョブ投入エラー: {str(e)}"
+            print(f"[ERROR] {error_msg}")
+            self.send_json_response({"error": error_msg}, 500)
+    
+    def handle_job_list(self):
+        """ジョブ一覧API（session_id で絞り込み可能）"""
+        query = parse_qs(urlparse(self.path).query)
+        session_id = query.get('session_id', [None])[0]
+        
+        with jobs_lock:
+            job_list = [job.to_dict() for job in jobs.values()
+                        if session_id is None or job.session_id == session_id]
+        
+        self.send_json_response({"jobs": job_list})
+    
+    def handle_job_status(self, job_id):
+        """ジョブ状態取得API（メモリにない場合は保存済みの結果を返す）"""
+        job = jobs.get(job_id)
+        if job is not None:
+            self.send_json_response(job.to_dict())
+            return
+        
+        result_path = os.path.join(JOBS_DIRECTORY, f"{job_id}.json")
+        try:
+            with open(result_path, 'r', encoding='utf-8') as f:
+                self.send_json_response(json.load(f))
+        except (OSError, json.JSONDecodeError):
+            self.send_json_response({"error": f"ジョブが見つかりません: {job_id}"}, 404)
+    
+    def handle_job_stream(self, job_id):
+        """ジョブのイベントをSSEで配信（Last-Event-ID で再開可能）"""
+        job = jobs.get(job_id)
+        if job is None:
+            self.send_json_response({"error": f"ジョブが見つかりません: {job_id}"}, 404)
+            return
+        
+        try:
+            last_event_id = int(self.headers.get('Last-Event-ID', 0))
+        except ValueError:
+            last_event_id = 0
+        
+        try:
+            self.send_stream_headers()
+            self.relay_stream_events(job, last_event_id)
+        except BrokenPipeError:
+            print(f"[INFO] クライアント接続切断: job {job_id}")
+    
+    def handle_job_timeline(self, job_id):
+        """ジョブのツール実行タイムライン取得API"""
+        job = jobs.get(job_id)
+        if job is None:
+            self.send_json_response({"error": f"ジョブが見つかりません: {job_id}"}, 404)
+            return
+        
+        self.send_json_response(dict(job.timeline_summary(), job_id=job_id))
+    
+    def handle_chat_timeline(self):
+        """セッションの最新ランのツール実行タイムライン取得API"""
+        query = parse_qs(urlparse(self.path).query)
+        session_id = query.get('session_id', [''])[0]
+        
+        run = stream_runs.get(session_id)
+        if run is None:
+            self.send_json_response({"error": "タイムラインがありません", "session_id": session_id}, 404)
+            return
+        
+        self.send_json_response(run.timeline_summary())
+    
+    def handle_tool_metrics(self):
+        """ツールごとのレイテンシヒストグラム取得API"""
+        with tool_latency_lock:
+            tools = {}
+            for tool_name, histogram in tool_latency_histograms.items():
+                tools[tool_name] = dict(
+                    histogram,
+                    buckets=list(histogram["buckets"]),
+                    avg_ms=round(histogram["sum_ms"] / histogram["count"])
+                )
+        
+        self.send_json_response({
+            "bucket_bounds_ms": TOOL_LATENCY_BUCKETS_MS,
+            "tools": tools
+        })
+    
+    def handle_changes(self):
+        """直近のランで変更されたファイル一覧と、要求に応じた unified diff を返すAPI"""
+        import difflib
+        
+        query = parse_qs(urlparse(self.path).query)
+        session_id = query.get('session_id', [''])[0]
+        directory = query.get('directory', [session_directories.get(session_id, STARTUP_DIRECTORY)])[0]
+        requested_path = query.get('path', [None])[0]
+        include_diffs = query.get('include_diffs', ['false'])[0].lower() == 'true'
+        
+        with session_changes_lock:
+            changes = session_changes.get(session_id, {}).get(directory)
+        if changes is None:
+            self.send_json_response({"error": "変更履歴がありません", "session_id": session_id, "directory": directory}, 404)
+            return
+        
+        files = []
+        for file_info in changes["files"]:
+            if requested_path and file_info["path"] != requested_path:
+                continue
+            entry = dict(file_info)
+            if requested_path or include_diffs:
+                before = changes["before"].get(file_info["path"])
+                after = ChangeTracker.read_text(os.path.join(directory, file_info["path"])) if file_info["status"] != 'deleted' else ''
+                if (before is None and file_info["status"] != 'added') or after is None:
+                    entry["diff"] = None
+                    entry["note"] = "変更前の内容を保持していないか、バイナリ・大きすぎるファイルのため差分を表示できません"
+                else:
+                    entry["diff"] = "".join(difflib.unified_diff(
+                        (before or '').splitlines(keepends=True),
+                        after.splitlines(keepends=True),
+                        fromfile=f"a/{file_info['path']}",
+                        tofile=f"b/{file_info['path']}"
+                    ))
+            files.append(entry)
+        
+        if requested_path and not files:
+            self.send_json_response({"error": f"変更されたファイルではありません: {requested_path}"}, 404)
+            return
+        
+        self.send_json_response({
+            "session_id": session_id,
+            "directory": directory,
+            "finished_at": changes["finished_at"],
+            "truncated": changes["truncated"],
+            "overlapped": changes["overlapped"],
+            "files": files
+        })
+    
+    def handle_healthz(self):
+        """ライブネスチェックAPI"""
+        self.send_json_response({
+            "status": "ok",
+            "instance_id": INSTANCE_ID,
+            "uptime_seconds": round(time.monotonic() - SERVER_STARTED_AT, 1) if SERVER_STARTED_AT else 0,
+            "startup_ms": STARTUP_TIME_MS,
+            "startup_budget_ms": STARTUP_TIME_BUDGET_MS
+        })
+    
+    def handle_readyz(self):
+        """レディネスチェックAPI（CLIの有無と処理中の負荷を報告）"""
+        import shutil
+        
+        cli_path = shutil.which(CLAUDE_COMMAND_PREFIX)
+        with stream_runs_lock:
+            active_streams = sum(1 for run in stream_runs.values() if not run.finished)
+        with jobs_lock:
+            running_jobs = sum(1 for job in jobs.values() if not job.finished)
+        
+        ready = cli_path is not None
+        self.send_json_response({
+            "status": "ready" if ready else "not_ready",
+            "instance_id": INSTANCE_ID,
+            "cli_available": ready,
+            "cli_path": cli_path,
+            "in_flight": {
+                "streams": active_streams,
+                "jobs": running_jobs,
+                "threads": threading.active_count()
+            }
+        }, 200 if ready else 503)
+    
+    def handle_job_cancel(self, job_id):
+        """ジョブキャンセルAPI"""
+        job = jobs.get(job_id)
+        if job is None:
+            self.send_json_response({"error": f"ジョブが見つかりません: {job_id}"}, 404)
+            return
+        
+        if not job.finished:
+            job.cancel()
+            print(f"[INFO] ジョブキャンセル: {job_id}")
+        
+        self.send_json_response(job.to_dict())
+    
+    def enforce_request_limits(self, session_id):
+        """レート制限・クォータ超過時は429を返して False を返す"""
+        limit = check_request_limits(session_id, self.client_address[0])
+        if limit is None:
+            return True
+        
+        error_msg, retry_after = limit
+        retry_after = max(1, int(retry_after + 0.999))
+        print(f"[INFO] 制限超過: {session_id[:8]} ({self.client_address[0]}) - {error_msg}")
+        self.send_json_response(
+            {"error": error_msg, "retry_after": retry_after, "session_id": session_id},
+            429,
+            {'Retry-After': str(retry_after)}
+        )
+        return False
+    
+    def send_json_response(self, result, status=200, headers=None):
+        """JSONレスポンスを送信"""
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self.send_body(body, 'application/json; charset=utf-8', status, headers)
+    
+    def send_body(self, body, content_type, status=200, headers=None):
+        """レスポンス本文を送信（閾値以上ならネゴシエートした方式で一括圧縮）"""
+        encoding = self.negotiate_encoding() if len(body) >= COMPRESSION_MIN_SIZE else None
+        if encoding:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, COMPRESSION_WBITS[encoding])
+            body = compressor.compress(body) + compressor.flush()
+        
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def negotiate_encoding(self):
+        """Accept-Encoding から使用する圧縮方式を決定（gzip 優先、なければ None）"""
+        if not ENABLE_COMPRESSION:
+            return None
+        
+        accepted = {}
+        for part in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = part.strip().partition(';')
+            quality = 1.0
+            match = re.search(r'q=([0-9.]+)', params)
+            if match:
+                try:
+                    quality = float(match.group(1))
+                except ValueError:
+                    quality = 0.0
+            accepted[name.strip().lower()] = quality
+        
+        for encoding in ('gzip', 'deflate'):
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+    
+    def send_stream_headers(self):
+        """SSEレスポンスのヘッダーを送信"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Expires', '0')
+        self.send_header('Connection', 'close')  # 接続を確実に閉じる
+        self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Last-Event-ID')
+        self.send_header('Vary', 'Accept-Encoding')
+        
+        # SSEはストリーミング圧縮（イベントごとに同期フラッシュ）
+        encoding = self.negotiate_encoding()
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+            self.stream_compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, COMPRESSION_WBITS[encoding])
+        self.end_headers()
+        
+        # 即座にフラッシュ
+        self.wfile.flush()
+    
+    def write_stream(self, data):
+        """SSEのバイト列を送信（圧縮時はイベント境界で Z_SYNC_FLUSH し、遅延を増やさない）"""
+        if self.stream_compressor:
+            data = self.stream_compressor.compress(data) + self.stream_compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        self.wfile.flush()
+    
+    def end_stream(self):
+        """圧縮ストリームを終端"""
+        if self.stream_compressor:
+            self.wfile.write(self.stream_compressor.flush())
+            self.wfile.flush()
+            self.stream_compressor = None
+    
+    def run_stream_worker(self, run, user_message, session_id, current_dir, timeout=CLAUDE_STREAM_TIMEOUT):
+        """CLIを実行してイベントをランに発行し、完了時に履歴を更新"""
+        try:
+            final_response = self.handle_claude_stream(user_message, session_id, run, timeout)
+            run.final_response = final_response
+            
+            # 応答を履歴に追加（ディレクトリ情報も含める）
+            history = chat_sessions.get(session_id, [])
+            history.append(f"Assistant: {final_response} [作業ディレクトリ: {current_dir}]")
+            
+            # セッションを保存（設定値に基づく）
+            chat_sessions[session_id] = history[-MAX_MESSAGES_PER_SESSION:]
+        except Exception as e:
+            import traceback
+            error_msg = f"ストリーミングエラー: {str(e)}"
+            print(f"[ERROR] {error_msg}")
+            print(traceback.format_exc())
+            run.publish({"error": error_msg})
+        finally:
+            # 終了シグナル
+            run.publish('[DONE]')
+            run.finish()
+    
+    def relay_stream_events(self, run, last_event_id):
+        """ランのイベントをクライアントへ中継（切断されてもランは継続）"""
+        try:
+            while True:
+                events, finished = run.wait_for_events(last_event_id, STREAM_KEEPALIVE_INTERVAL)
+                if events:
+                    for event_id, data in events:
+                        self.send_stream_data(data, event_id)
+                        last_event_id = event_id
+                elif finished:
+                    break
+                else:
+                    # 切断検知のためのキープアライブ
+                    self.write_stream(b': keepalive\n\n')
+            self.end_stream()
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"[INFO] クライアント接続切断（処理は継続）: {run.session_id[:8]} (Last-Event-ID: {last_event_id})")
+    
+    def handle_claude_stream(self, message, session_id, run, timeout=CLAUDE_STREAM_TIMEOUT, working_dir=None):
+        """Claude Code CLIをストリーミング実行し、イベントをランに発行（working_dir でセッションのディレクトリを上書き）"""
+        tracker = None
+        spawned_at = None
+        usage_recorded = False
         try:
             # セッション履歴を取得してコンテキストを構築
             history = chat_sessions.get(session_id, [])
@@ -245,7 +1560,7 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             is_markdown_request = self.is_markdown_related_request(message)
             
             # セッションの作業ディレクトリを取得
-            current_dir = session_directories.get(session_id, STARTUP_DIRECTORY)
+            current_dir = working_dir or session_directories.get(session_id, STARTUP_DIRECTORY)
             directory_context = f"""
 
 重要な作業ディレクトリ情報:
@@ -327,15 +1642,29 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                 "message": "処理を開始しています...",
                 "session_id": session_id
             }
-            self.send_stream_data(init_data)
+            run.publish(init_data)
             
             # プロセス実行
-            current_dir = session_directories.get(session_id, STARTUP_DIRECTORY)
+            current_dir = working_dir or session_directories.get(session_id, STARTUP_DIRECTORY)
             # 環境変数を設定してディレクトリコンテキストを強化
             env = os.environ.copy()
             env['CLAUDE_WORKING_DIR'] = current_dir
             env['PWD'] = current_dir
             
+            # 実行前のスナップショット（前回からの差分のみ再走査）
+            # 未準備の場合は stat のみで索引を作り、内容の読み込みはラン終了後にバックグラウンドで行う
+            # 同じディレクトリで追跡中のランがある場合、このランは追跡しない
+            tracker = acquire_change_tracker(current_dir) if ENABLE_CHANGE_TRACKING else None
+            if tracker:
+                with tracker.lock:
+                    tracker.refresh(cache_contents=tracker.warmed)
+            
+            # 準備中にキャンセルされた場合はプロセスを起動しない
+            if run.cancelled:
+                print(f"[INFO] Claude Code プロセスをキャンセルしました（起動前）")
+                return "⚠️ 処理がキャンセルされました"
+            
+            spawned_at = time.monotonic()
             process = subprocess.Popen(
                 cmd + [claude_prompt],
                 stdout=subprocess.PIPE,
@@ -346,17 +1675,23 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                 cwd=current_dir,
                 env=env
             )
+            run.process = process
+            
+            # process 設定前に届いたキャンセルを反映
+            if run.cancelled:
+                process.kill()
             
             full_response = ""
             current_message = ""
             
-            # タイムアウト設定
-            import signal
-            def timeout_handler(signum, frame):
-                raise TimeoutError("Claude Code プロセスがタイムアウトしました")
+            # タイムアウト設定（ワーカースレッドではSIGALRMが使えないためタイマーでkill）
+            def timeout_handler():
+                run.timed_out = True
+                process.kill()
             
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(CLAUDE_STREAM_TIMEOUT)  # 設定値に基づくタイムアウト
+            timer = threading.Timer(timeout, timeout_handler)  # 設定値に基づくタイムアウト
+            timer.daemon = True
+            timer.start()
             
             try:
                 # ストリーミング処理
@@ -371,8 +1706,19 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                             line_data = json.loads(output.strip())
                             processed_data = self.process_stream_line(line_data, session_id)
                             
+                            # コストと実行時間をクォータに計上（エラー終了の result も含む）
+                            if line_data.get("type") == "result" and not usage_recorded:
+                                run.cost = line_data.get("cost_usd") or 0.0
+                                duration_ms = line_data.get("duration_ms") or round((time.monotonic() - spawned_at) * 1000)
+                                record_session_usage(session_id, run.cost, duration_ms)
+                                usage_recorded = True
+                            
+                            # ツール呼び出しの開始・終了イベント
+                            for tool_event in self.process_tool_events(line_data, session_id, run):
+                                run.publish(tool_event)
+                            
                             if processed_data:
-                                self.send_stream_data(processed_data)
+                                run.publish(processed_data)
                                 
                                 # メッセージ内容を蓄積
                                 if processed_data.get("type") == "assistant" and "content" in processed_data:
@@ -384,13 +1730,21 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                             
                 # プロセス終了待ち
                 return_code = process.wait(timeout=10)
+                run.return_code = return_code
                 
-            except TimeoutError:
+            finally:
+                timer.cancel()  # タイムアウト解除
+            
+            # 実行後のスナップショットと比較して変更ファイルを通知
+            if tracker:
+                self.publish_file_changes(run, session_id, tracker)
+            
+            if run.cancelled:
+                print(f"[INFO] Claude Code プロセスをキャンセルしました")
+                return "⚠️ 処理がキャンセルされました"
+            if run.timed_out:
                 print(f"[ERROR] Claude Code プロセスタイムアウト")
-                process.kill()
                 return "⏰ Claude Codeの処理がタイムアウトしました"
-            finally:
-                signal.alarm(0)  # タイムアウト解除
             
             if return_code == 0:
                 if current_message:
@@ -409,6 +1763,12 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
             print(f"[ERROR] ストリーミング実行エラー: {str(e)}")
             print(traceback.format_exc())
             return f"❌ ストリーミング実行エラー: {str(e)}"
+        finally:
+            # タイムアウト・キャンセル・異常終了で result がなかった場合は経過時間を計上
+            if spawned_at is not None and not usage_recorded:
+                record_session_usage(session_id, run.cost, round((time.monotonic() - spawned_at) * 1000))
+            if tracker:
+                release_change_tracker(tracker)
     
     def process_stream_line(self, line_data, session_id):
         """ストリームラインデータを処理"""
@@ -454,14 +1814,114 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
         
         return None
     
-    def send_stream_data(self, data):
-        """ストリームデータを送信"""
-        try:
-            json_data = json.dumps(data, ensure_ascii=False)
-            self.wfile.write(f'data: {json_data}\n\n'.encode('utf-8'))
-            self.wfile.flush()
-        except Exception as e:
-            print(f"[ERROR] ストリーム送信エラー: {e}")
+    def publish_file_changes(self, run, session_id, tracker):
+        """実行前後のスナップショットを比較し、files_changed イベントを発行"""
+        started_at = time.monotonic()
+        with tracker.lock:
+            previous_files = set(tracker.files)
+            replaced = tracker.refresh(cache_contents=tracker.warmed)
+            current_files = set(tracker.files)
+        
+        files = []
+        before = {}
+        for file_path, content in sorted(replaced.items()):
+            relative_path = os.path.relpath(file_path, tracker.root)
+            if file_path not in current_files:
+                status = 'deleted'
+            elif file_path not in previous_files:
+                status = 'added'
+            else:
+                status = 'modified'
+            files.append({"path": relative_path, "status": status})
+            before[relative_path] = content
+        
+        store_session_changes(session_id, tracker.root, {
+            "files": files,
+            "before": before,
+            "before_bytes": sum(len(content) for content in before.values() if content is not None),
+            "truncated": tracker.truncated,
+            "overlapped": tracker.overlapped,
+            "finished_at": datetime.now().isoformat()
+        })
+        
+        if files:
+            run.publish({
+                "type": "files_changed",
+                "session_id": session_id,
+                "directory": tracker.root,
+                "added": sum(1 for f in files if f["status"] == 'added'),
+                "modified": sum(1 for f in files if f["status"] == 'modified'),
+                "deleted": sum(1 for f in files if f["status"] == 'deleted'),
+                "files": files[:200],
+                "truncated": tracker.truncated,
+                "overlapped": tracker.overlapped,
+                "scan_ms": round((time.monotonic() - started_at) * 1000)
+            })
+    
+    def process_tool_events(self, line_data, session_id, run):
+        """tool_use / tool_result を計測付きのイベントに変換し、タイムラインに記録"""
+        line_type = line_data.get("type", "")
+        if line_type not in ("assistant", "user"):
+            return []
+        
+        events = []
+        now = time.time()
+        for content in line_data.get("message", {}).get("content", []):
+            if not isinstance(content, dict):
+                continue
+            
+            if content.get("type") == "tool_use":
+                tool_input = content.get("input", {})
+                entry = {
+                    "tool_use_id": content.get("id", ""),
+                    "name": content.get("name", "unknown"),
+                    "summary": self.summarize_tool_input(tool_input),
+                    "started_at": round(now, 3),
+                    "offset_ms": round((now - run.started_at) * 1000),
+                    "ended_at": None,
+                    "duration_ms": None,
+                    "output_size": 0,
+                    "is_error": False
+                }
+                run.add_tool_entry(entry)
+                run.pending_tools[entry["tool_use_id"]] = entry
+                events.append(dict(entry, type="tool_start", session_id=session_id))
+            
+            elif content.get("type") == "tool_result":
+                entry = run.pending_tools.pop(content.get("tool_use_id", ""), None)
+                if entry is None:
+                    continue
+                
+                # 出力サイズ（文字列またはテキストブロックのリスト）
+                output = content.get("content", "")
+                if isinstance(output, list):
+                    output = "".join(block.get("text", "") for block in output if isinstance(block, dict))
+                
+                entry["ended_at"] = round(now, 3)
+                entry["duration_ms"] = round((now - entry["started_at"]) * 1000)
+                entry["output_size"] = len(str(output).encode('utf-8'))
+                entry["is_error"] = bool(content.get("is_error", False))
+                record_tool_latency(entry["name"], entry["duration_ms"])
+                events.append(dict(entry, type="tool_end", session_id=session_id))
+        
+        return events
+    
+    def summarize_tool_input(self, tool_input):
+        """ツール入力から表示用の短い要約を作成"""
+        if not isinstance(tool_input, dict):
+            return ""
+        for key in ("command", "file_path", "path", "pattern", "url", "description"):
+            if tool_input.get(key):
+                return str(tool_input[key])[:120]
+        return ""
+    
+    def send_stream_data(self, data, event_id=None):
+        """ストリームデータを送信（event_id 指定時は id: フィールドを付与）"""
+        json_data = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+        event = f'data: {json_data}\n\n'
+        if event_id is not None:
+            event = f'id: {event_id}\n' + event
+        self.write_stream(event.encode('utf-8'))
     
     def handle_claude_conversation(self, message, context, session_id):
         """Claude Code CLIとの実際の対話"""
@@ -667,6 +2127,10 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                 success = False
                 message = "パスが指定されていません"
             
+            # 次のランに備えて変更トラッカーをバックグラウンドで準備
+            if success:
+                warm_change_tracker(session_directories[session_id])
+            
             # レスポンス
             result = {
                 "success": success,
@@ -675,21 +2139,13 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                 "session_id": session_id
             }
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
-            self.end_headers()
-            self.wfile.write(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+            self.send_json_response(result)
             
         except Exception as e:
             error_msg = f"ディレクトリ変更エラー: {str(e)}"
             print(f"[ERROR] {error_msg}")
             
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": error_msg}, ensure_ascii=False).encode('utf-8'))
+            self.send_json_response({"error": error_msg}, 500)
     
     def handle_directory_info(self):
         """ディレクトリ情報取得API"""
@@ -740,28 +2196,20 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
                     "session_id": session_id
                 }
             
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
-            self.end_headers()
-            self.wfile.write(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+            self.send_json_response(result)
             
         except Exception as e:
             error_msg = f"ディレクトリ情報取得エラー: {str(e)}"
             print(f"[ERROR] {error_msg}")
             
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": error_msg}, ensure_ascii=False).encode('utf-8'))
+            self.send_json_response({"error": error_msg}, 500)
     
     def do_OPTIONS(self):
         # Handle CORS preflight
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', CORS_ALLOW_ORIGIN)
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Last-Event-ID')
         self.end_headers()
     
     
@@ -776,20 +2224,21 @@ class ClaudeChatHandler(http.server.SimpleHTTPRequestHandler):
         super().log_message(format, *args)
 
 
-def check_port_available(host, port):
-    """ポートが使用可能かチェック"""
-    import socket
+def discover_lan_address(port):
+    """LANのIPアドレスを調べてURLを表示（起動をブロックしないようスレッドで実行）"""
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.settimeout(1)
-            result = sock.connect_ex((host, port))
-            return result != 0  # 0なら接続できた（ポート使用中）
+        hostname_result = subprocess.run(['hostname', '-I'], capture_output=True, text=True, timeout=5)
+        if hostname_result.returncode == 0 and hostname_result.stdout.strip():
+            # Get the first IP address from the output
+            actual_ip = hostname_result.stdout.strip().split()[0]
+            print(f"📍 LAN URL: http://{actual_ip}:{port}/claude_chat.html")
     except Exception:
-        return True  # エラーの場合は使用可能と判断
+        pass
 
 def main():
     """Main entry point for the package"""
-    global PORT, HOST
+    global PORT, HOST, STARTUP_TIME_MS, SERVER_STARTED_AT
+    import argparse
     
     parser = argparse.ArgumentParser(
         description='Claude Code Chat Server - Multiple instances supported',
@@ -814,12 +2263,22 @@ Examples:
     PORT = args.port
     HOST = args.host
     
-    # ポートが使用可能かチェック
-    if not check_port_available(HOST, PORT):
-        print(f"❌ Error: Port {PORT} is already in use on {HOST}")
+    # ポートの再利用を許可
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    # ストリーム実行中も再接続を受け付けられるようスレッドで処理
+    socketserver.ThreadingTCPServer.daemon_threads = True
+    
+    # 接続プローブは行わず、バインドの失敗でポート使用中を検出
+    try:
+        httpd = socketserver.ThreadingTCPServer((HOST, PORT), ClaudeChatHandler)
+    except OSError as e:
+        print(f"❌ Error: Port {PORT} is already in use on {HOST} ({e})")
         print(f"💡 Try a different port: {parser.prog} --port {PORT + 1}")
         return 1
     
+    SERVER_STARTED_AT = time.monotonic()
+    STARTUP_TIME_MS = round((SERVER_STARTED_AT - _IMPORT_STARTED_AT) * 1000, 1)
+    
     # インスタンス識別子を生成
     instance_id = f"PID{os.getpid()}"
     
@@ -842,34 +2301,32 @@ Examples:
 {RESET}    """)
     print(f"{DARK_ORANGE}{'=' * 80}{RESET}")
     
-    # Get actual IP address
-    try:
-        hostname_result = subprocess.run(['hostname', '-I'], capture_output=True, text=True)
-        if hostname_result.returncode == 0 and hostname_result.stdout.strip():
-            # Get the first IP address from the output
-            actual_ip = hostname_result.stdout.strip().split()[0]
-        else:
-            actual_ip = HOST
-    except:
-        actual_ip = HOST
+    # 全インターフェースで待ち受ける場合はローカルURLを表示（LANのURLは後からバックグラウンドで表示）
+    display_host = '127.0.0.1' if HOST in ('0.0.0.0', '') else HOST
     
     print(f"\n🚀 Claude Code Chat Server v1.0.0 [Instance: {instance_id}]")
-    print(f"📍 URL: http://{actual_ip}:{PORT}/claude_chat.html")
+    print(f"📍 URL: http://{display_host}:{PORT}/claude_chat.html")
     print(f"📁 Root Directory: {STARTUP_DIRECTORY}")
     print(f"🔧 Process ID: {os.getpid()}")
     print("=" * 80)
     print("💬 会話型インターフェース")
     print("🔧 デバッグモード有効")
     print(f"⏰ タイムアウト: {CLAUDE_TIMEOUT}秒")
+    print(f"⚡ 起動時間: {STARTUP_TIME_MS}ms")
+    if STARTUP_TIME_MS > STARTUP_TIME_BUDGET_MS:
+        print(f"[WARN] 起動時間が目標 ({STARTUP_TIME_BUDGET_MS}ms) を超えています")
     print("📦 Multiple instances supported")
     print("=" * 60)
     print(f"\n{instance_id} - 待機中 (Port: {PORT})...\n")
     
-    # ポートの再利用を許可
-    socketserver.TCPServer.allow_reuse_address = True
+    if HOST in ('0.0.0.0', ''):
+        threading.Thread(target=discover_lan_address, args=(PORT,), daemon=True).start()
+    
+    # 起動ディレクトリの変更トラッカーを最初のランまでに準備
+    warm_change_tracker(STARTUP_DIRECTORY)
     
     try:
-        with socketserver.TCPServer((HOST, PORT), ClaudeChatHandler) as httpd:
+        with httpd:
             httpd.serve_forever()
     except KeyboardInterrupt:
         print("\n\n👋 サーバーを停止します...")
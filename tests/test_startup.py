@@ -0,0 +1,69 @@
+"""起動開始から /healthz が応答するまでの時間が予算内に収まっていることを確認するテスト"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# プロセス起動から最初の /healthz 応答までの予算（インタプリタ起動とインポートを含む）
+# サーバーの環境変数に左右されないようテスト側で固定する
+STARTUP_BUDGET_MS = 500
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_healthz(port, process, timeout=10):
+    """/healthz が応答するまで待って JSON を返す"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            pytest.fail(f"サーバーが終了しました (code: {process.returncode})")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz", timeout=1) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except OSError:
+            time.sleep(0.01)
+    pytest.fail("/healthz が応答しませんでした")
+
+
+@pytest.fixture
+def server(tmp_path):
+    port = find_free_port()
+    env = dict(os.environ, PYTHONPATH=PROJECT_ROOT)
+    started_at = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'claude_code_chat.server', '--port', str(port), '--host', '127.0.0.1'],
+        cwd=tmp_path,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        yield port, process, started_at
+    finally:
+        process.terminate()
+        process.wait(timeout=5)
+
+
+def test_startup_within_budget(server):
+    port, process, started_at = server
+    health = wait_for_healthz(port, process)
+    elapsed_ms = (time.monotonic() - started_at) * 1000
+
+    assert health["status"] == "ok"
+    assert health["startup_ms"] is not None
+    assert elapsed_ms <= STARTUP_BUDGET_MS, (
+        f"起動から /healthz 応答まで {elapsed_ms:.0f}ms かかり、予算 {STARTUP_BUDGET_MS}ms を超えています"
+        f"（サーバー計測の起動時間: {health['startup_ms']}ms）"
+    )